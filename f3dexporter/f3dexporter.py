@@ -8,11 +8,13 @@ import adsk.fusion
 import traceback
 from pathlib import Path
 from datetime import datetime
-from typing import NamedTuple, List, Set
+from typing import List, Set, Tuple
 from enum import Enum
 from dataclasses import dataclass
+import functools
 import hashlib
-import re
+import json
+import os
 import typing
 
 log_file = None
@@ -22,7 +24,6 @@ handlers = []
 
 def log(*args):
     print(*args, file=log_fh)
-    log_fh.flush()
 
 def init_directory(name):
     directory = Path(name)
@@ -32,7 +33,10 @@ def init_directory(name):
 def init_logging(directory):
     global log_file, log_fh
     log_file = directory / '{:%Y_%m_%d_%H_%M}.txt'.format(datetime.now())
-    log_fh = open(log_file, 'w')
+    # buffer generously, flushing per line costs a syscall per entry on big trees
+    log_fh = open(log_file, 'w', buffering=1 << 16)
+    # each log file should mention every renamed file at least once
+    _logged_bad_names.clear()
 
 class Format(Enum):
     F3D = 'f3d'
@@ -40,22 +44,37 @@ class Format(Enum):
 
 FormatFromName = {x.value: x for x in Format}
 
+# ExportManager factory for each format's export options
+_FORMAT_DISPATCH = {
+    Format.F3D: 'createFusionArchiveExportOptions',
+    Format.STEP: 'createSTEPExportOptions',
+}
+
+# plain str lookups so the hot path doesn't go through the Enum `value` descriptor
+_FORMAT_EXT = {f: f.value for f in Format}
+
 DEFAULT_SELECTED_FORMATS = {Format.F3D, Format.STEP}
 
-class Ctx(NamedTuple):
+# hand written __slots__ rather than dataclass(slots=True), which needs python 3.10
+@dataclass
+class Ctx:
+    __slots__ = ('folder', 'formats', 'app', 'projects')
+
     folder: Path
     formats: List[Format]
     app: adsk.core.Application
     projects: Set[str]
 
     def extend(self, other):
-        return self._replace(folder=self.folder / other)
+        # everything but the folder is shared with the parent
+        return Ctx(self.folder / other, self.formats, self.app, self.projects)
 
 class LazyDocument:
     def __init__(self, ctx, file):
         self._ctx = ctx
         self._file = file
         self._document = None
+        self._design = None
 
     def open(self):
         if self._document is not None:
@@ -63,6 +82,7 @@ class LazyDocument:
         log(f'Opening `{self._file.name}`')
         self._document = self._ctx.app.documents.open(self._file)
         self._document.activate()
+        self._design = design_from_document(self._document)
 
     def update(self):
         self._ctx.app.executeTextCommand(u'Commands.Start PLM360DeepRefreshDocumentCommand')
@@ -72,27 +92,28 @@ class LazyDocument:
             return
         log(f'Closing {self._file.name}')
         self._document.close(False)  # don't save changes
+        self._document = None
+        self._design = None
 
     @property
     def design(self):
-        return design_from_document(self._document)
+        return self._design
     
     @property
     def rootComponent(self):
         return self.design.rootComponent
 
-@dataclass
 class Counter:
-    saved: int = 0
-    skipped: int = 0
-    errored: int = 0
-
-    def __add__(self, other):
-        return Counter(
-            self.saved + other.saved,
-            self.skipped + other.skipped,
-            self.errored + other.errored,
-        )
+    __slots__ = ('saved', 'skipped', 'errored')
+
+    def __init__(self, saved: int = 0, skipped: int = 0, errored: int = 0):
+        self.saved = saved
+        self.skipped = skipped
+        self.errored = errored
+
+    def __repr__(self):
+        return f'Counter(saved={self.saved}, skipped={self.skipped}, errored={self.errored})'
+
     def __iadd__(self, other):
         self.saved += other.saved
         self.skipped += other.skipped
@@ -102,32 +123,101 @@ class Counter:
 def design_from_document(document: adsk.core.Document):
     return adsk.fusion.FusionDocument.cast(document).design
 
+# this list of characters is just from trying to rename a file in Explorer (on Windows)
+# I think the actual requirements are per filesystem and will be different on Mac
+# I'm not sure how other unicode chars are handled
+_BAD_CHARS_TABLE = str.maketrans({c: ' ' for c in ':\\/*?<>|'})
+
+@functools.lru_cache(maxsize=4096)
+def _sanitize_core(name: str) -> Tuple[str, str]:
+    with_replacement = name.translate(_BAD_CHARS_TABLE)
+    if name == with_replacement:
+        return name, with_replacement
+    hash = hashlib.sha256(name.encode()).hexdigest()[:8]
+    return f'{with_replacement}_{hash}', with_replacement
+
+_logged_bad_names = set()
+
 def sanitize_filename(name: str) -> str:
     """
     Remove "bad" characters from a filename. Right now just punctuation that Windows doesn't like
     If any chars are removed, we append _{hash} so that we don't accidentally clobber other files
     since eg `Model 1/2` and `Model 1 2` would otherwise have the same name
     """
-    # this list of characters is just from trying to rename a file in Explorer (on Windows)
-    # I think the actual requirements are per filesystem and will be different on Mac
-    # I'm not sure how other unicode chars are handled
-    with_replacement = re.sub(r'[:\\/*?<>|]', ' ', name)
-    if name == with_replacement:
-        return name
-    log(f'filename `{name}` contained bad chars, replacing by `{with_replacement}`')
-    hash = hashlib.sha256(name.encode()).hexdigest()[:8]
-    return f'{with_replacement}_{hash}'
+    sanitized, with_replacement = _sanitize_core(name)
+    if sanitized != name and name not in _logged_bad_names:
+        _logged_bad_names.add(name)
+        log(f'filename `{name}` contained bad chars, replacing by `{with_replacement}`')
+    return sanitized
 
 def export_filename(ctx: Ctx, format: Format, file):
     sanitized = sanitize_filename(file.name)
-    name = f'{sanitized}.{format.value}'
+    name = f'{sanitized}.{_FORMAT_EXT[format]}'
     return ctx.folder / name
 
-def export_file(ctx: Ctx, format: Format, file, doc: LazyDocument) -> Counter:
+class ExportManifest:
+    """
+    The Fusion version each file in an output folder was exported from, kept in a json file beside
+    the exports so that unchanged designs can be skipped on the next run. Also creates the folder itself
+    on the first export into it
+    """
+    FILENAME = 'exported_versions.json'
+
+    def __init__(self, folder: Path):
+        self._folder = folder
+        self._path = folder / self.FILENAME
+        self._versions = None
+        self._dirty = False
+        self._folder_created = False
+
+    def ensure_folder(self):
+        # only made once something is actually exported into it, and then just the once
+        if self._folder_created:
+            return
+        self._folder.mkdir(exist_ok=True, parents=True)
+        self._folder_created = True
+
+    def _load(self):
+        if self._versions is not None:
+            return self._versions
+        try:
+            with open(self._path) as fh:
+                versions = json.load(fh)
+        except FileNotFoundError:
+            versions = {}
+        except ValueError:
+            versions = None
+        # valid json can still be the wrong shape, eg after a bad merge
+        if not isinstance(versions, dict):
+            log(f'Could not parse {self._path}, everything in this folder will be exported again')
+            versions = {}
+        self._versions = versions
+        return self._versions
+
+    def version(self, name: str):
+        return self._load().get(name)
+
+    def record(self, name: str, version: int):
+        self._load()[name] = version
+        self._dirty = True
+
+    def save(self):
+        if not self._dirty:
+            return
+        # write then rename so an interrupted save can't leave a truncated manifest behind
+        tmp_path = self._path.with_name(self._path.name + '.tmp')
+        with open(tmp_path, 'w') as fh:
+            json.dump(self._versions, fh, indent=2, sort_keys=True)
+            fh.write('\n')
+        os.replace(tmp_path, self._path)
+        self._dirty = False
+
+def export_file(ctx: Ctx, format: Format, file, doc: LazyDocument, counter: Counter, manifest: ExportManifest):
     output_path = export_filename(ctx, format, file)
-    # if output_path.exists():
-    #     log(f'{output_path} already exists, skipping')
-    #     return Counter(skipped=1)
+    if manifest.version(output_path.name) == file.versionNumber and output_path.exists():
+        log(f'{output_path} is already at v{file.versionNumber}, skipping')
+        counter.skipped += 1
+        return
 
     doc.open()
 
@@ -136,67 +226,74 @@ def export_file(ctx: Ctx, format: Format, file, doc: LazyDocument) -> Counter:
     design = doc.design
     em = design.exportManager
 
-    output_path.parent.mkdir(exist_ok=True, parents=True)
-    
-    # leaving this ugly, not sure what else there might be to handle per format
-    if format == Format.F3D:
-        options = em.createFusionArchiveExportOptions(str(output_path))
-    elif format == Format.STEP:
-        options = em.createSTEPExportOptions(str(output_path))
-    else:
+    create_options = _FORMAT_DISPATCH.get(format)
+    if create_options is None:
         raise Exception(f'Got unknown export format {format}')
+    manifest.ensure_folder()
+    options = getattr(em, create_options)(str(output_path))
 
     em.execute(options)
     log(f'Saved {output_path}')
+    manifest.record(output_path.name, file.versionNumber)
     
-    return Counter(saved=1)
+    counter.saved += 1
 
-def visit_file(ctx: Ctx, file, is_dry_run: bool, progress: adsk.core.ProgressDialog) -> Counter:
+def visit_file(ctx: Ctx, file, is_dry_run: bool, progress: adsk.core.ProgressDialog, counter: Counter, manifest: ExportManifest):
     log(f'Visiting file {file.name} v{file.versionNumber} . {file.fileExtension}')
 
     if file.fileExtension != 'f3d':
         log(f'file {file.name} has extension {file.fileExtension} which is not currently handled, skipping')
-        return Counter(skipped=1)
+        counter.skipped += 1
+        return
 
-    doc = LazyDocument(ctx, file)
+    # nothing will be exported, so there's no point setting up the document
+    if is_dry_run:
+        return
 
-    counter = Counter()
+    doc = LazyDocument(ctx, file)
 
+    # every assignment repaints the dialog, so once per file rather than once per format
+    progress.message = "Exporting {}...".format(file.name)
     for format in ctx.formats:
-        progress.message = "Exporting {} as {}...".format(file.name, format)
-        if not is_dry_run:
-            try:
-                counter += export_file(ctx, format, file, doc)
-            except Exception:
-                counter.errored += 1
-                log(traceback.format_exc())
+        try:
+            export_file(ctx, format, file, doc, counter, manifest)
+        except Exception:
+            counter.errored += 1
+            log(traceback.format_exc())
     
     doc.close()
-    return counter
 
-def visit_folder(ctx: Ctx, folder, is_dry_run: bool, progress: adsk.core.ProgressDialog) -> Counter:
+def visit_folder(ctx: Ctx, root_folder, is_dry_run: bool, progress: adsk.core.ProgressDialog) -> Counter:
     counter = Counter()
-        
-    if progress.wasCancelled:
-        return counter
+    stack = [(ctx, root_folder)]
+
+    while stack:
+        if progress.wasCancelled:
+            break
+
+        parent_ctx, folder = stack.pop()
 
-    progress.message = "Visiting folder {}".format(folder.name)
-    log(f'Visiting folder {folder.name}')
+        progress.message = "Visiting folder {}".format(folder.name)
+        log(f'Visiting folder {folder.name}')
 
-    new_ctx = ctx.extend(sanitize_filename(folder.name))
+        new_ctx = parent_ctx.extend(sanitize_filename(folder.name))
 
-    for file in folder.dataFiles:
+        manifest = ExportManifest(new_ctx.folder)
         try:
-            counter += visit_file(new_ctx, file, is_dry_run, progress)
-        except Exception:
-            log(f'Got exception visiting file\n{traceback.format_exc()}')
-            counter.errored += 1
+            for file in folder.dataFiles:
+                try:
+                    visit_file(new_ctx, file, is_dry_run, progress, counter, manifest)
+                except Exception:
+                    log(f'Got exception visiting file\n{traceback.format_exc()}')
+                    counter.errored += 1
+        finally:
+            manifest.save()
 
-    progress.progressValue += 1
+        progress.progressValue += 1
+
+        # pushed in reverse so that sub folders are visited in the same order as before
+        stack.extend(reversed([(new_ctx, sub_folder) for sub_folder in folder.dataFolders]))
 
-    for sub_folder in folder.dataFolders:
-        counter += visit_folder(new_ctx, sub_folder, is_dry_run, progress)
-    
     return counter
 
 def main(ctx: Ctx) -> Counter:
@@ -271,6 +368,10 @@ class ExporterCommandExecuteHandler(adsk.core.CommandEventHandler):
     def selected(inputs):
         return [it.name for it in inputs if it.isSelected]
 
+    @staticmethod
+    def selected_set(inputs):
+        return {it.name for it in inputs if it.isSelected}
+
     def notify(self, args):
         try:
             inputs = args.command.commandInputs
@@ -282,10 +383,15 @@ class ExporterCommandExecuteHandler(adsk.core.CommandEventHandler):
                 app = app,
                 folder = Path(inputs.itemById('directory').value),
                 formats = [FormatFromName[x] for x in self.selected(inputs.itemById('file_types').listItems)],
-                projects = set(self.selected(inputs.itemById('projects').listItems)),
+                projects = self.selected_set(inputs.itemById('projects').listItems),
             )
 
+            if not ctx.formats:
+                ui.messageBox('No export formats selected, nothing to export')
+                return
+
             counter = main(ctx)
+            log_fh.flush()  # so the log is complete while the message box is up
 
             ui.messageBox('\n'.join((
                 f'Saved {counter.saved} files',
@@ -296,9 +402,11 @@ class ExporterCommandExecuteHandler(adsk.core.CommandEventHandler):
 
         except:
             tb = traceback.format_exc()
-            adsk.core.Application.get().userInterface.messageBox(f'Log file is at {log_file}\n{tb}')
-            if log_fh is not None:
+            # may still be the closed log of a previous run if we failed before opening this one
+            if log_fh is not None and not log_fh.closed:
                 log(f'Got top level exception\n{tb}')    
+                log_fh.flush()  # so the log is complete while the message box is up
+            adsk.core.Application.get().userInterface.messageBox(f'Log file is at {log_file}\n{tb}')
         finally:
             if log_fh is not None:
                 log_fh.close()